@@ -1,10 +1,27 @@
-import json
+import asyncio
+import hashlib
 import logging
 import os
+import pickle
+import time
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+from urllib.parse import urlparse
 
+import orjson
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -14,14 +31,19 @@ from telegram import (
 )
 from telegram.error import BadRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
     filters,
 )
+from telegram.ext._picklepersistence import _BotPickler
 
 # =========================================================
 # PATHS
@@ -31,7 +53,15 @@ BASE_DIR = Path(__file__).resolve().parent
 
 CATALOG_PATH = BASE_DIR / "catalog.json"
 STOCK_PATH = BASE_DIR / "stock.json"
-ORDERS_PATH = BASE_DIR / "orders.json"
+
+# Files the bot writes at runtime. Point STATE_DIR at a mounted volume so
+# carts, orders and cached photo ids survive a container redeploy.
+STATE_DIR = Path(os.getenv("STATE_DIR", BASE_DIR))
+STATE_DIR.mkdir(parents=True, exist_ok=True)
+
+ORDERS_PATH = STATE_DIR / "orders.json"
+STATE_PATH = STATE_DIR / "bot_state.pkl"
+PHOTO_IDS_PATH = STATE_DIR / "photo_ids.json"
 
 # =========================================================
 # LOGGING
@@ -39,9 +69,12 @@ ORDERS_PATH = BASE_DIR / "orders.json"
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(message)s",
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
 )
 
+# httpx logs every Telegram API request at INFO; keep only its problems.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 logger = logging.getLogger(__name__)
 
 # =========================================================
@@ -53,6 +86,11 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN not set")
 
+# Webhook mode is enabled when WEBHOOK_URL is set; otherwise the bot polls.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8443"))
+
 
 def parse_admin_ids() -> List[int]:
     raw = os.getenv("ADMIN_IDS", "7406405860,721379009")
@@ -66,7 +104,17 @@ def parse_admin_ids() -> List[int]:
     return result
 
 
-ADMIN_IDS = parse_admin_ids()
+ADMIN_IDS = tuple(parse_admin_ids())
+# Ordered tuple for notification fan-out, set for O(1) membership checks.
+ADMIN_ID_SET = frozenset(ADMIN_IDS)
+
+# Updates from different users are processed in parallel; the HTTP pool
+# has to be at least as large or sends queue up waiting for a connection.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+CONNECTION_POOL_SIZE = int(os.getenv("CONNECTION_POOL_SIZE", str(CONCURRENT_UPDATES * 2)))
+
+# Carts live in the persisted user_data, so keep each one bounded.
+MAX_CART_ITEMS = int(os.getenv("MAX_CART_ITEMS", "50"))
 
 CITY_CONFIG: Dict[str, Dict[str, Any]] = {
     "Berlin": {
@@ -91,6 +139,9 @@ CITY_CONFIG: Dict[str, Dict[str, Any]] = {
     },
 }
 
+# Fallback for unknown or missing city keys, resolved once.
+DEFAULT_CITY_CONFIG = CITY_CONFIG["Other"]
+
 # =========================================================
 # JSON HELPERS
 # =========================================================
@@ -99,15 +150,51 @@ CITY_CONFIG: Dict[str, Dict[str, Any]] = {
 def write_json(path: Path, data: Any) -> None:
     try:
         tmp_path = path.with_suffix(f"{path.suffix}.tmp")
-        tmp_path.write_text(
-            json.dumps(data, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
         tmp_path.replace(path)
     except Exception as e:
         logger.exception("Failed writing %s: %s", path, e)
 
 
+# path -> (latest snapshot still waiting to be written, callback run after
+# the write). Callers pass data that is no longer mutated, because it is
+# serialised in a worker thread.
+_PENDING_WRITES: Dict[Path, Tuple[Any, Optional[Callable[[], None]]]] = {}
+_WRITER_TASK: Optional["asyncio.Task[None]"] = None
+
+
+def write_json_later(
+    path: Path,
+    data: Any,
+    on_written: Optional[Callable[[], None]] = None,
+) -> None:
+    """Write data to path off the event loop; back-to-back writes coalesce."""
+    global _WRITER_TASK
+
+    _PENDING_WRITES[path] = (data, on_written)
+
+    if _WRITER_TASK is None or _WRITER_TASK.done():
+        _WRITER_TASK = asyncio.create_task(flush_pending_writes())
+
+
+async def flush_pending_writes() -> None:
+    while _PENDING_WRITES:
+        path = next(iter(_PENDING_WRITES))
+        data, on_written = _PENDING_WRITES.pop(path)
+
+        await asyncio.to_thread(write_json, path, data)
+
+        if on_written:
+            on_written()
+
+
+async def wait_for_pending_writes() -> None:
+    # Writes queued while we wait are picked up by the same task, or by a
+    # new one that write_json_later starts; never run a second flusher.
+    while _WRITER_TASK is not None and not _WRITER_TASK.done():
+        await _WRITER_TASK
+
+
 def ensure_runtime_files() -> None:
     if not STOCK_PATH.exists():
         write_json(STOCK_PATH, {})
@@ -119,7 +206,7 @@ def read_json(path: Path, default: Any) -> Any:
     try:
         if not path.exists():
             return default
-        return json.loads(path.read_text(encoding="utf-8"))
+        return orjson.loads(path.read_bytes())
     except Exception as e:
         logger.exception("Failed reading %s: %s", path, e)
         return default
@@ -130,9 +217,27 @@ ensure_runtime_files()
 CATALOG = read_json(CATALOG_PATH, {})
 STOCK = read_json(STOCK_PATH, {})
 
+
+def file_mtime_ns(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+# Both files are kept in memory; /reload re-reads them only if these moved.
+CATALOG_MTIME_NS = file_mtime_ns(CATALOG_PATH)
+STOCK_MTIME_NS = file_mtime_ns(STOCK_PATH)
+
 if not isinstance(STOCK, dict):
     STOCK = {}
 
+# The last 1000 orders, appended in memory and flushed by write_json_later.
+ORDERS: List[Dict[str, Any]] = read_json(ORDERS_PATH, [])
+
+if not isinstance(ORDERS, list):
+    ORDERS = []
+
 CURRENCY = CATALOG.get("currency", "EUR")
 
 # =========================================================
@@ -141,7 +246,7 @@ CURRENCY = CATALOG.get("currency", "EUR")
 
 
 def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_ID_SET
 
 
 def item_key(*parts: Any) -> str:
@@ -155,16 +260,62 @@ def fmt_price(value: Any) -> str:
         return f"{value} {CURRENCY}"
 
 
+# [minute since epoch, formatted timestamp] of the last fmt_timestamp() call.
+_TIMESTAMP_CACHE: List[Any] = [-1, ""]
+
+
+def fmt_timestamp(epoch: float) -> str:
+    # Orders within the same minute share one formatted string.
+    minute = int(epoch // 60)
+
+    if _TIMESTAMP_CACHE[0] != minute:
+        now = datetime.fromtimestamp(epoch)
+        _TIMESTAMP_CACHE[0] = minute
+        _TIMESTAMP_CACHE[1] = (
+            f"{now.day:02d}.{now.month:02d}.{now.year} {now.hour:02d}:{now.minute:02d}"
+        )
+
+    return _TIMESTAMP_CACHE[1]
+
+
 def get_username(user) -> str:
     return f"@{user.username}" if user and user.username else f"id:{user.id}"
 
 
-def cart_get(context: ContextTypes.DEFAULT_TYPE) -> List[Dict[str, Any]]:
+class CartItem(NamedTuple):
+    key: str
+    name: str
+    price: float
+
+
+def cart_get(context: ContextTypes.DEFAULT_TYPE) -> List[CartItem]:
     return context.user_data.setdefault("cart", [])
 
 
-def cart_total(cart: List[Dict[str, Any]]) -> float:
-    return round(sum(float(x["price"]) for x in cart), 2)
+def cart_total(context: ContextTypes.DEFAULT_TYPE) -> float:
+    # Maintained incrementally by cart_add / cart_remove_last / cart_clear.
+    return context.user_data.get("cart_total", 0.0)
+
+
+def cart_add(context: ContextTypes.DEFAULT_TYPE, item: CartItem) -> None:
+    cart_get(context).append(item)
+    context.user_data["cart_total"] = round(cart_total(context) + item.price, 2)
+
+
+def cart_remove_last(context: ContextTypes.DEFAULT_TYPE) -> None:
+    cart = cart_get(context)
+    if not cart:
+        return
+
+    item = cart.pop()
+    context.user_data["cart_total"] = (
+        round(cart_total(context) - item.price, 2) if cart else 0.0
+    )
+
+
+def cart_clear(context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data["cart"] = []
+    context.user_data["cart_total"] = 0.0
 
 
 def stock_get(key: str) -> Dict[str, Any]:
@@ -176,7 +327,14 @@ def stock_set(key: str, in_stock: bool, eta: Optional[str] = None) -> None:
         "in_stock": in_stock,
         "eta": eta,
     }
-    write_json(STOCK_PATH, STOCK)
+    write_json_later(STOCK_PATH, dict(STOCK), on_written=remember_stock_mtime)
+    refresh_stock_markups()
+
+
+def remember_stock_mtime() -> None:
+    # Our own write must not look like an external edit to /reload.
+    global STOCK_MTIME_NS
+    STOCK_MTIME_NS = file_mtime_ns(STOCK_PATH)
 
 
 def get_city_key(context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -189,21 +347,17 @@ def get_city_title(context: ContextTypes.DEFAULT_TYPE) -> str:
     if city_key == "Other":
         return context.user_data.get("custom_city", "Інше місто")
 
-    return CITY_CONFIG.get(city_key, CITY_CONFIG["Other"])["title"]
+    return CITY_CONFIG.get(city_key, DEFAULT_CITY_CONFIG)["title"]
 
 
 def get_city_config(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
-    return CITY_CONFIG.get(get_city_key(context), CITY_CONFIG["Other"])
+    return CITY_CONFIG.get(get_city_key(context), DEFAULT_CITY_CONFIG)
 
 
 def save_order(order: Dict[str, Any]) -> None:
-    orders = read_json(ORDERS_PATH, [])
-
-    if not isinstance(orders, list):
-        orders = []
-
-    orders.append(order)
-    write_json(ORDERS_PATH, orders[-1000:])
+    ORDERS.append(order)
+    del ORDERS[:-1000]
+    write_json_later(ORDERS_PATH, list(ORDERS))
 
 
 def extract_flavor_name(flavor: Any) -> str:
@@ -221,35 +375,11 @@ def categories_get() -> Dict[str, Any]:
     return categories if isinstance(categories, dict) else {}
 
 
-def category_get(cat_key: str) -> Optional[Dict[str, Any]]:
-    return categories_get().get(cat_key)
-
-
-def brand_get(cat_key: str, brand_key: str) -> Optional[Dict[str, Any]]:
-    category = category_get(cat_key)
-
-    if not category:
-        return None
-
-    brands = category.get("brands", {})
-    if not isinstance(brands, dict):
-        return None
-
-    return brands.get(brand_key)
-
-
 def items_get(container: Dict[str, Any]) -> List[Any]:
     items = container.get("items", [])
     return items if isinstance(items, list) else []
 
 
-def parse_idx(value: str) -> Optional[int]:
-    try:
-        return int(value)
-    except (TypeError, ValueError):
-        return None
-
-
 def has_city(context: ContextTypes.DEFAULT_TYPE) -> bool:
     return bool(context.user_data.get("city_key"))
 
@@ -269,12 +399,27 @@ def set_active_menu_id(
 # =========================================================
 
 
+_BACKGROUND_TASKS: Set["asyncio.Task[Any]"] = set()
+
+
+def spawn(coro: Coroutine[Any, Any, Any]) -> None:
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def _answer_callback_quietly(update: Update) -> None:
+    try:
+        await update.callback_query.answer()
+    except Exception:
+        pass
+
+
 async def answer_callback(update: Update) -> None:
+    # Acknowledge the button in the background so the menu edit that follows
+    # does not wait for an extra Telegram round-trip.
     if update.callback_query:
-        try:
-            await update.callback_query.answer()
-        except Exception:
-            pass
+        spawn(_answer_callback_quietly(update))
 
 
 async def delete_message_safe(
@@ -307,31 +452,67 @@ async def show_stale_callback(
     text: str = "⚠️ Це меню застаріло або вже недійсне. Я відкрив актуальне меню.",
 ) -> None:
     if has_city(context):
-        await show_text(update, text, kb_main(), context=context)
+        await show_text(update, text, KB_MAIN, context=context)
         return
 
     await start(update, context)
 
 
+# photo_cache_key(photo) -> Telegram file_id of the first upload. Saved on
+# shutdown so restarts do not re-upload every photo.
+PHOTO_FILE_IDS: Dict[str, str] = read_json(PHOTO_IDS_PATH, {})
+
+if not isinstance(PHOTO_FILE_IDS, dict):
+    PHOTO_FILE_IDS = {}
+
+
+def photo_cache_key(photo: str) -> str:
+    # Local photos are keyed by content as well, so a file replaced under the
+    # same name is uploaded again instead of showing the old image.
+    local = PHOTO_BYTES.get(photo)
+    return local[2] if local else photo
+
+
+async def save_state_on_shutdown(app: Application) -> None:
+    await wait_for_pending_writes()
+
+    # Only keep ids for photos the current catalog still shows.
+    current = {photo_cache_key(photo) for photo in catalog_photos()}
+    write_json(
+        PHOTO_IDS_PATH,
+        {key: file_id for key, file_id in PHOTO_FILE_IDS.items() if key in current},
+    )
+
+
 def resolve_photo_source(photo: str) -> Tuple[Optional[str], Optional[Any]]:
     if not photo:
         logger.warning("Photo path is empty")
         return None, None
 
+    file_id = PHOTO_FILE_IDS.get(photo_cache_key(photo))
+    if file_id:
+        return "file_id", file_id
+
     if photo.startswith("http://") or photo.startswith("https://"):
-        logger.info("Using remote photo: %s", photo)
+        logger.debug("Using remote photo: %s", photo)
         return "remote", photo
 
-    path = (BASE_DIR / photo).resolve()
+    local = PHOTO_BYTES.get(photo)
 
-    if path.exists():
-        logger.info("Using local photo: %s", path)
-        return "local", path
+    if local:
+        logger.debug("Using local photo: %s", photo)
+        return "local", local
 
-    logger.warning("Photo file not found: %s", path)
+    logger.warning("Photo file not found: %s", photo)
     return None, None
 
 
+def remember_photo_file_id(photo: str, message: Any) -> None:
+    sizes = getattr(message, "photo", None)
+    if sizes:
+        PHOTO_FILE_IDS.setdefault(photo_cache_key(photo), sizes[-1].file_id)
+
+
 async def show_text(
     update: Update,
     text: str,
@@ -424,52 +605,61 @@ async def show_photo(
         return
 
     try:
-        if update.callback_query and update.callback_query.message:
-            if source_type == "remote":
-                await update.callback_query.edit_message_media(
-                    media=InputMediaPhoto(media=source, caption=caption),
-                    reply_markup=reply_markup,
-                )
-                set_active_menu_id(context, update.callback_query.message.message_id)
-                return
-
+        # Telegram cannot turn a text message into a photo, so only try to
+        # edit in place when the menu message already carries a photo.
+        q = update.callback_query
+        if q and q.message and q.message.photo:
+            media = source
             if source_type == "local":
-                with open(source, "rb") as f:
-                    await update.callback_query.edit_message_media(
-                        media=InputMediaPhoto(
-                            media=InputFile(f, filename=source.name),
-                            caption=caption,
-                        ),
-                        reply_markup=reply_markup,
-                    )
-                set_active_menu_id(context, update.callback_query.message.message_id)
-                return
+                filename, data, _ = source
+                media = InputFile(data, filename=filename)
+
+            edited = await q.edit_message_media(
+                media=InputMediaPhoto(media=media, caption=caption),
+                reply_markup=reply_markup,
+            )
+
+            remember_photo_file_id(photo, edited)
+            set_active_menu_id(context, q.message.message_id)
+            return
 
     except BadRequest as e:
         if "message is not modified" in str(e).lower():
             return
+        logger.warning("Photo edit failed: %s", e)
+        if source_type == "file_id":
+            # The cached id is stale; send from the original photo instead.
+            PHOTO_FILE_IDS.pop(photo_cache_key(photo), None)
+            source_type, source = resolve_photo_source(photo)
     except Exception as e:
         logger.exception("Photo send failed: %s", e)
 
+    if source_type is None:
+        await show_text(
+            update,
+            caption,
+            reply_markup,
+            context=context,
+            cleanup_user=cleanup_user,
+        )
+        return
+
     try:
         previous_id = get_active_menu_id(context)
 
-        if source_type == "remote":
-            sent = await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=source,
-                caption=caption,
-                reply_markup=reply_markup,
-            )
-        else:
-            with open(source, "rb") as f:
-                sent = await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=InputFile(f, filename=source.name),
-                    caption=caption,
-                    reply_markup=reply_markup,
-                )
+        media = source
+        if source_type == "local":
+            filename, data, _ = source
+            media = InputFile(data, filename=filename)
+
+        sent = await context.bot.send_photo(
+            chat_id=update.effective_chat.id,
+            photo=media,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
 
+        remember_photo_file_id(photo, sent)
         set_active_menu_id(context, sent.message_id)
 
         if previous_id and previous_id != sent.message_id:
@@ -484,6 +674,8 @@ async def show_photo(
         return
 
     except Exception as e:
+        if source_type == "file_id":
+            PHOTO_FILE_IDS.pop(photo_cache_key(photo), None)
         logger.exception("Photo send fallback failed: %s", e)
 
     await show_text(
@@ -510,14 +702,19 @@ async def send_message_safe(
 
 async def notify_targets(
     context: ContextTypes.DEFAULT_TYPE,
-    recipients: List[int],
+    recipients: Tuple[int, ...],
     text: str,
 ) -> Tuple[List[int], List[int]]:
     delivered: List[int] = []
     failed: List[int] = []
 
-    for chat_id in recipients:
-        if await send_message_safe(context, chat_id, text):
+    # send_message_safe never raises, so the sends can simply run concurrently.
+    results = await asyncio.gather(
+        *(send_message_safe(context, chat_id, text) for chat_id in recipients)
+    )
+
+    for chat_id, ok in zip(recipients, results):
+        if ok:
             delivered.append(chat_id)
         else:
             failed.append(chat_id)
@@ -529,352 +726,583 @@ async def notify_targets(
 # =========================================================
 
 
-def kb_main() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🛍 Каталог", callback_data="catalog")],
-        [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
-    ])
-
-
-def kb_after_add() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Додати ще", callback_data="catalog")],
-        [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
-        [InlineKeyboardButton("⬅ На головну", callback_data="main")],
-    ])
+# Static keyboards are built once; InlineKeyboardMarkup is immutable in PTB 20.
+
+KB_CITY = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📍 Берлін", callback_data="city:Berlin")],
+    [InlineKeyboardButton("📍 Лейпциг", callback_data="city:Leipzig")],
+    [InlineKeyboardButton("📍 Дрезден", callback_data="city:Dresden")],
+    [InlineKeyboardButton("✍️ Інше місто", callback_data="city:Other")],
+])
+
+KB_MAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛍 Каталог", callback_data="catalog")],
+    [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
+])
+
+KB_AFTER_ADD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Додати ще", callback_data="catalog")],
+    [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
+    [InlineKeyboardButton("⬅ На головну", callback_data="main")],
+])
+
+KB_CATALOG_HOME = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛍 Каталог", callback_data="catalog")],
+    [InlineKeyboardButton("⬅ На головну", callback_data="main")],
+])
+
+KB_CART_HOME = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
+    [InlineKeyboardButton("⬅ На головну", callback_data="main")],
+])
+
+KB_CART = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Додати ще", callback_data="catalog")],
+    [InlineKeyboardButton("➖ Прибрати останній", callback_data="remove_last")],
+    [InlineKeyboardButton("🗑 Очистити кошик", callback_data="clear_cart")],
+    [InlineKeyboardButton("✅ Оформити", callback_data="checkout")],
+    [InlineKeyboardButton("⬅ На головну", callback_data="main")],
+])
 
 # =========================================================
 # ITEM RESOLVER
 # =========================================================
 
 
-def resolve_item(key: str) -> Optional[Dict[str, Any]]:
-    try:
-        parts = key.split(":")
-        kind = parts[0]
+class CatalogItem(NamedTuple):
+    id: str
+    key: str
+    name: str
+    price: float
+    photo: str
+    cart_item: CartItem
+    added_text: str
+
+
+def item_id(key: str, name: str, price: float) -> str:
+    # Derived from the item's key, name and price. The key is positional
+    # (category, brand, list position), so reordering a list or inserting
+    # an entry before this one retires the id, as does renaming or
+    # repricing. Either way old add:/reserve: buttons go stale instead of
+    # resolving to a different product.
+    return hashlib.blake2b(
+        f"{key}\0{name}\0{price}".encode(),
+        digest_size=5,
+    ).hexdigest()
+
+
+def catalog_entry(
+    key: str,
+    name: str,
+    price: float,
+    photo: Optional[str],
+) -> CatalogItem:
+    # The cart line and the "added" caption are baked in once per item.
+    return CatalogItem(
+        item_id(key, name, price),
+        key,
+        name,
+        price,
+        photo or "",
+        CartItem(key, name, price),
+        f"✅ Додано в кошик\n\n🧾 {name}\n💶 {fmt_price(price)}",
+    )
 
-        if kind == "brand":
-            if len(parts) != 4:
-                return None
 
-            _, cat_key, brand_key, idx = parts
+def build_item_index() -> Dict[str, CatalogItem]:
+    """Flatten every orderable catalog leaf into {item key: item}."""
+    index: Dict[str, CatalogItem] = {}
+
+    for cat_key, cat in categories_get().items():
+        brands = cat.get("brands", {})
+        if not isinstance(brands, dict):
+            continue
+
+        for brand_key, brand in brands.items():
+            if not isinstance(brand, dict):
+                continue
+
+            for idx, item in enumerate(items_get(brand)):
+                if not isinstance(item, dict):
+                    continue
+
+                try:
+                    photo = item.get("photo") or brand.get("photo")
+
+                    if "nicotine" in item:
+                        kind = "nic"
+                        prefix = f"{brand.get('title')} {item.get('nicotine')}"
+                    elif isinstance(item.get("items"), list):
+                        kind = "flv"
+                        prefix = f"{item.get('name')}"
+                    else:
+                        key = item_key("brand", cat_key, brand_key, idx)
+                        index[key] = catalog_entry(
+                            key,
+                            item["name"],
+                            float(item["price"]),
+                            photo,
+                        )
+                        continue
+
+                    price = float(item["price"])
+
+                    for flavor_idx, flavor in enumerate(items_get(item)):
+                        key = item_key(kind, cat_key, brand_key, idx, flavor_idx)
+                        index[key] = catalog_entry(
+                            key,
+                            f"{prefix} — {extract_flavor_name(flavor)}",
+                            price,
+                            photo,
+                        )
+
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(
+                        "Skipping malformed catalog item %s:%s:%s: %s",
+                        cat_key,
+                        brand_key,
+                        idx,
+                        e,
+                    )
 
-            brand = brand_get(cat_key, brand_key)
-            item_idx = parse_idx(idx)
+    return index
 
-            if not brand or item_idx is None:
-                return None
 
-            items = items_get(brand)
-            if item_idx < 0 or item_idx >= len(items):
-                return None
+ITEM_INDEX = build_item_index()
 
-            item = items[item_idx]
-            if not isinstance(item, dict):
-                return None
 
-            return {
-                "key": key,
-                "name": item["name"],
-                "price": float(item["price"]),
-                "photo": item.get("photo") or brand.get("photo"),
-            }
+def build_id_index(index: Dict[str, CatalogItem]) -> Dict[str, CatalogItem]:
+    by_id: Dict[str, CatalogItem] = {}
+    clashes: Set[str] = set()
 
-        if kind == "nic":
-            if len(parts) != 5:
-                return None
+    for item in index.values():
+        if item.id in by_id:
+            logger.error("Item id clash: %s and %s", by_id[item.id].key, item.key)
+            clashes.add(item.id)
+        by_id[item.id] = item
 
-            _, cat_key, brand_key, block_idx, flavor_idx = parts
+    # An ambiguous id must never resolve, or a button could add the wrong item.
+    for clash in clashes:
+        del by_id[clash]
 
-            brand = brand_get(cat_key, brand_key)
-            block_index = parse_idx(block_idx)
-            flavor_index = parse_idx(flavor_idx)
+    return by_id
 
-            if not brand or block_index is None or flavor_index is None:
-                return None
 
-            brand_items = items_get(brand)
-            if block_index < 0 or block_index >= len(brand_items):
-                return None
+# Short stable ids keep add:/reserve: callback_data small ("add:3f9a01c2e4").
+ITEMS_BY_ID = build_id_index(ITEM_INDEX)
 
-            block = brand_items[block_index]
-            if not isinstance(block, dict):
-                return None
 
-            flavors = items_get(block)
-            if flavor_index < 0 or flavor_index >= len(flavors):
-                return None
+def resolve_callback_item(payload: str) -> Optional[CatalogItem]:
+    # Ids retired by a catalog change (and older key-based payloads) give
+    # None, which the handlers report as an outdated menu.
+    return ITEMS_BY_ID.get(payload)
 
-            flavor_name = extract_flavor_name(flavors[flavor_index])
+# =========================================================
+# PRECOMPUTED MENUS
+# =========================================================
 
-            return {
-                "key": key,
-                "name": f"{brand.get('title')} {block.get('nicotine')} — {flavor_name}",
-                "price": float(block["price"]),
-                "photo": block.get("photo") or brand.get("photo"),
-            }
+# (photo, text, reply_markup); an empty photo means a plain text menu.
+Menu = Tuple[str, str, InlineKeyboardMarkup]
 
-        if kind == "flv":
-            if len(parts) != 5:
-                return None
 
-            _, cat_key, brand_key, parent_idx, flavor_idx = parts
+def build_static_menus() -> Dict[str, Menu]:
+    """Menus that depend only on the catalog, keyed by their callback_data."""
+    menus: Dict[str, Menu] = {}
+    categories = categories_get()
 
-            brand = brand_get(cat_key, brand_key)
-            parent_index = parse_idx(parent_idx)
-            flavor_index = parse_idx(flavor_idx)
+    if not categories:
+        return menus
 
-            if not brand or parent_index is None or flavor_index is None:
-                return None
+    keyboard = []
 
-            brand_items = items_get(brand)
-            if parent_index < 0 or parent_index >= len(brand_items):
-                return None
+    for cat_key, cat in categories.items():
+        keyboard.append([
+            InlineKeyboardButton(cat["title"], callback_data=f"cat:{cat_key}")
+        ])
 
-            parent = brand_items[parent_index]
-            if not isinstance(parent, dict):
-                return None
+    keyboard.append([
+        InlineKeyboardButton("⬅ На головну", callback_data="main")
+    ])
 
-            flavors = items_get(parent)
-            if flavor_index < 0 or flavor_index >= len(flavors):
-                return None
+    menus["catalog"] = (
+        "",
+        "🛍 Каталог\n\nОберіть категорію:",
+        InlineKeyboardMarkup(keyboard),
+    )
 
-            flavor_name = extract_flavor_name(flavors[flavor_index])
+    for cat_key, cat in categories.items():
+        brands = cat.get("brands", {})
+        if not isinstance(brands, dict):
+            menus[f"cat:{cat_key}"] = ("", "❌ У категорії немає брендів", KB_MAIN)
+            continue
 
-            return {
-                "key": key,
-                "name": f"{parent.get('name')} — {flavor_name}",
-                "price": float(parent["price"]),
-                "photo": parent.get("photo") or brand.get("photo"),
-            }
+        keyboard = []
 
-    except Exception as e:
-        logger.exception("resolve_item failed: %s", e)
+        for brand_key, brand in brands.items():
+            keyboard.append([
+                InlineKeyboardButton(
+                    brand["title"],
+                    callback_data=f"brand:{cat_key}:{brand_key}",
+                )
+            ])
 
-    return None
+        keyboard.append([
+            InlineKeyboardButton("⬅ Назад", callback_data="catalog")
+        ])
 
-# =========================================================
-# START
-# =========================================================
+        menus[f"cat:{cat_key}"] = (
+            cat.get("photo", ""),
+            f"{cat['title']}\n\nОберіть бренд:",
+            InlineKeyboardMarkup(keyboard),
+        )
 
+    return menus
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    context.user_data.clear()
 
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📍 Берлін", callback_data="city:Berlin")],
-        [InlineKeyboardButton("📍 Лейпциг", callback_data="city:Leipzig")],
-        [InlineKeyboardButton("📍 Дрезден", callback_data="city:Dresden")],
-        [InlineKeyboardButton("✍️ Інше місто", callback_data="city:Other")],
-    ])
+STATIC_MENUS = build_static_menus()
 
-    await show_text(
-        update,
-        "👋 Вітаємо у ELF FOX\n\n📍 Оберіть ваше місто:",
-        keyboard,
-        context=context,
-    )
+# Stock-aware keyboards, keyed by callback_data. Prebuilt at startup and
+# rebuilt by refresh_stock_markups() on every stock change.
+MARKUP_CACHE: Dict[str, InlineKeyboardMarkup] = {}
 
 
-async def city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await answer_callback(update)
+def stock_button(key: str, label: str) -> InlineKeyboardButton:
+    st = stock_get(key)
+    item = ITEM_INDEX.get(key)
+    payload = item.id if item else key
 
-    q = update.callback_query
-    if not q or not q.data:
-        await show_stale_callback(update, context)
-        return
+    if st.get("in_stock", True):
+        return InlineKeyboardButton(f"{label} ✅", callback_data=f"add:{payload}")
 
-    city_key = q.data.split(":", 1)[1]
-    context.user_data["city_key"] = city_key
+    eta = st.get("eta")
+    label = f"{label} ❌"
+    if eta:
+        label += f" ({eta})"
 
-    if city_key == "Other":
-        context.user_data["awaiting_city"] = True
-        await show_text(update, "✍️ Напишіть назву вашого міста:", context=context)
-        return
+    return InlineKeyboardButton(label, callback_data=f"reserve:{payload}")
 
-    await show_main(update, context)
 
+def build_brand_markup(
+    cat_key: str,
+    brand_key: str,
+    brand: Dict[str, Any],
+) -> InlineKeyboardMarkup:
+    keyboard = []
 
-async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    city = get_city_title(context)
+    for idx, item in enumerate(items_get(brand)):
+        if isinstance(item, dict) and "nicotine" in item:
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{item['nicotine']} — {fmt_price(item['price'])}",
+                    callback_data=f"nic:{cat_key}:{brand_key}:{idx}",
+                )
+            ])
+        elif isinstance(item, dict) and isinstance(item.get("items"), list):
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{item['name']} — {fmt_price(item['price'])}",
+                    callback_data=f"flavors:{cat_key}:{brand_key}:{idx}",
+                )
+            ])
+        elif isinstance(item, dict):
+            key = item_key("brand", cat_key, brand_key, idx)
+            st = stock_get(key)
 
-    await show_text(
-        update,
-        f"🦊 ELF FOX\n\n📍 Ваше місто: {city}\n\nОберіть дію:",
-        kb_main(),
-        context=context,
-    )
+            # In-stock rows show the price, out-of-stock rows only the name.
+            if st.get("in_stock", True):
+                label = f"{item['name']} — {fmt_price(item['price'])}"
+            else:
+                label = item["name"]
 
+            keyboard.append([stock_button(key, label)])
 
-async def main_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await answer_callback(update)
-    await show_main(update, context)
+    keyboard.append([
+        InlineKeyboardButton("🛒 Кошик", callback_data="cart")
+    ])
+    keyboard.append([
+        InlineKeyboardButton("⬅ Назад", callback_data=f"cat:{cat_key}")
+    ])
 
-# =========================================================
-# TEXT ROUTER
-# =========================================================
+    return InlineKeyboardMarkup(keyboard)
 
 
-async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = (update.message.text or "").strip()
+def build_flavors_markup(
+    kind: str,
+    cat_key: str,
+    brand_key: str,
+    parent_idx: int,
+    parent: Dict[str, Any],
+) -> InlineKeyboardMarkup:
+    keyboard = []
 
-    if context.user_data.get("awaiting_city"):
-        context.user_data["custom_city"] = text
-        context.user_data["awaiting_city"] = False
+    for idx, flavor in enumerate(items_get(parent)):
+        key = item_key(kind, cat_key, brand_key, parent_idx, idx)
+        keyboard.append([stock_button(key, extract_flavor_name(flavor))])
 
-        await show_main(update, context)
-        await delete_message_safe(
-            context,
-            update.effective_chat.id,
-            update.message.message_id,
-        )
-        return
+    keyboard.append([
+        InlineKeyboardButton("⬅ Назад", callback_data=f"brand:{cat_key}:{brand_key}")
+    ])
 
-    if context.user_data.get("reserve_key"):
-        key = context.user_data["reserve_key"]
-        item = resolve_item(key)
+    return InlineKeyboardMarkup(keyboard)
 
-        if not item:
-            await update.message.reply_text("❌ Товар не знайдено")
-            return
 
-        st = stock_get(key)
+# (photo, text, markup builder) for brand and flavour menus, keyed by
+# callback_data. Captions never change; markups depend on stock.
+StockMenu = Tuple[str, str, Callable[[], InlineKeyboardMarkup]]
 
-        reservation_text = (
-            "📌 НОВЕ БРОНЮВАННЯ\n\n"
-            f"👤 {get_username(update.effective_user)}\n"
-            f"📍 Місто: {get_city_title(context)}\n\n"
-            f"🧾 {item['name']}\n"
-            f"💶 {fmt_price(item['price'])}\n"
-            f"🗓 Очікується: {st.get('eta') or 'не вказано'}\n\n"
-            f"💬 Контакт:\n{text}"
-        )
 
-        delivered, _ = await notify_targets(context, ADMIN_IDS, reservation_text)
+def build_stock_menus() -> Dict[str, StockMenu]:
+    menus: Dict[str, StockMenu] = {}
 
-        if not delivered:
-            await show_text(
-                update,
-                "❌ Не вдалося передати бронювання. Спробуйте ще раз трохи пізніше.",
-                kb_main(),
-                context=context,
-                cleanup_user=True,
-            )
-            return
+    for cat_key, cat in categories_get().items():
+        brands = cat.get("brands", {})
+        if not isinstance(brands, dict):
+            continue
 
-        context.user_data.pop("reserve_key", None)
+        for brand_key, brand in brands.items():
+            try:
+                brand_photo = brand.get("photo", "")
 
-        await show_text(
-            update,
-            "✅ Бронювання передано адміну",
-            kb_main(),
-            context=context,
-            cleanup_user=True,
-        )
-        return
+                text = f"{brand['title']}"
+                if brand.get("price_range"):
+                    text += f"\n💶 {brand['price_range']}"
+                text += "\n\nОберіть товар:"
 
-    if not has_city(context):
-        await start(update, context)
-        await delete_message_safe(
-            context,
-            update.effective_chat.id,
-            update.message.message_id,
-        )
-        return
+                menus[f"brand:{cat_key}:{brand_key}"] = (
+                    brand_photo,
+                    text,
+                    partial(build_brand_markup, cat_key, brand_key, brand),
+                )
 
-    await show_text(
-        update,
-        "Я не очікував текст у цей момент. Скористайся кнопками нижче.",
-        kb_main(),
-        context=context,
-        cleanup_user=True,
-    )
+                for idx, item in enumerate(items_get(brand)):
+                    if not isinstance(item, dict):
+                        continue
 
-# =========================================================
-# CATALOG
-# =========================================================
+                    if "nicotine" in item:
+                        menus[f"nic:{cat_key}:{brand_key}:{idx}"] = (
+                            item.get("photo") or brand_photo,
+                            f"{brand['title']} {item['nicotine']}\n\nОберіть смак:",
+                            partial(build_flavors_markup, "nic", cat_key, brand_key, idx, item),
+                        )
+                    elif isinstance(item.get("items"), list):
+                        menus[f"flavors:{cat_key}:{brand_key}:{idx}"] = (
+                            item.get("photo") or brand_photo,
+                            f"{item['name']}\n\nОберіть смак:",
+                            partial(build_flavors_markup, "flv", cat_key, brand_key, idx, item),
+                        )
 
+            except (KeyError, TypeError) as e:
+                logger.warning("Skipping menus for %s:%s: %s", cat_key, brand_key, e)
 
-async def catalog_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await answer_callback(update)
+    return menus
 
-    categories = categories_get()
-    if not categories:
-        await show_text(update, "❌ Каталог тимчасово недоступний", kb_main(), context=context)
-        return
 
-    keyboard = []
+STOCK_MENUS = build_stock_menus()
 
-    for cat_key, cat in categories.items():
-        keyboard.append([
-            InlineKeyboardButton(cat["title"], callback_data=f"cat:{cat_key}")
-        ])
 
-    keyboard.append([
-        InlineKeyboardButton("⬅ На головну", callback_data="main")
-    ])
+def refresh_stock_markups() -> None:
+    MARKUP_CACHE.clear()
 
-    await show_text(
-        update,
-        "🛍 Каталог\n\nОберіть категорію:",
-        InlineKeyboardMarkup(keyboard),
-        context=context,
+    for cache_key, (_, _, build_markup) in STOCK_MENUS.items():
+        try:
+            MARKUP_CACHE[cache_key] = build_markup()
+        except (KeyError, TypeError) as e:
+            logger.warning("Skipping keyboard for %s: %s", cache_key, e)
+
+
+refresh_stock_markups()
+
+# Telegram rejects the whole keyboard if any callback_data exceeds 64 bytes.
+CALLBACK_DATA_LIMIT = 64
+
+
+def check_callback_data(markups: List[InlineKeyboardMarkup]) -> None:
+    for markup in markups:
+        for row in markup.inline_keyboard:
+            for button in row:
+                data = button.callback_data
+                if isinstance(data, str) and len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+                    logger.warning("callback_data longer than 64 bytes: %s", data)
+
+
+check_callback_data(
+    [menu[2] for menu in STATIC_MENUS.values()] + list(MARKUP_CACHE.values())
+)
+
+
+def catalog_photos() -> Set[str]:
+    photos = {menu[0] for menu in STATIC_MENUS.values()}
+    photos.update(menu[0] for menu in STOCK_MENUS.values())
+    photos.update(item.photo for item in ITEM_INDEX.values())
+    photos.discard("")
+    return photos
+
+
+# Local catalog photos are small, so they are read once here and uploads
+# never touch the disk from inside the event loop.
+# photo -> (file name, bytes, file_id cache key derived from the bytes).
+def load_local_photos() -> Dict[str, Tuple[str, bytes, str]]:
+    loaded: Dict[str, Tuple[str, bytes, str]] = {}
+
+    for photo in catalog_photos():
+        if photo.startswith(("http://", "https://")):
+            continue
+
+        path = (BASE_DIR / photo).resolve()
+
+        try:
+            data = path.read_bytes()
+        except OSError:
+            logger.warning("Photo file not found: %s", path)
+            continue
+
+        digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+        loaded[photo] = (path.name, data, f"{photo}#{digest}")
+
+    return loaded
+
+
+PHOTO_BYTES = load_local_photos()
+
+
+def reload_photos() -> int:
+    """Re-read local photos; returns how many changed on disk."""
+    global PHOTO_BYTES
+
+    loaded = load_local_photos()
+    changed = sum(
+        1
+        for photo, local in loaded.items()
+        if photo in PHOTO_BYTES and PHOTO_BYTES[photo][2] != local[2]
     )
+    PHOTO_BYTES = loaded
 
+    return changed
 
-async def category_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await answer_callback(update)
 
-    q = update.callback_query
-    if not q or not q.data:
-        await show_stale_callback(update, context)
-        return
+def reload_catalog() -> bool:
+    """Re-read catalog.json if it changed on disk and rebuild derived menus.
 
-    parts = q.data.split(":", 1)
-    if len(parts) != 2:
-        await show_stale_callback(update, context)
-        return
+    Raises if the file is unreadable or any build fails; the previously
+    loaded catalog then stays in place and the next /reload retries.
+    """
+    global CATALOG, CATALOG_MTIME_NS, CURRENCY
+    global ITEM_INDEX, ITEMS_BY_ID, PHOTO_BYTES, STATIC_MENUS, STOCK_MENUS
+
+    mtime = file_mtime_ns(CATALOG_PATH)
+    if mtime is None or mtime == CATALOG_MTIME_NS:
+        return False
 
-    cat_key = parts[1]
-    cat = category_get(cat_key)
+    catalog = read_json(CATALOG_PATH, None)
+    if not isinstance(catalog, dict):
+        raise ValueError("catalog.json is unreadable")
+
+    # The builders read the module globals, so the new catalog is swapped in
+    # and everything is put back if any build fails. This runs without an
+    # await, so no handler can observe the half-built state.
+    previous = (
+        CATALOG,
+        CURRENCY,
+        ITEM_INDEX,
+        ITEMS_BY_ID,
+        STATIC_MENUS,
+        STOCK_MENUS,
+        dict(MARKUP_CACHE),
+        PHOTO_BYTES,
+    )
 
-    if not cat:
-        await show_stale_callback(
-            update,
-            context,
-            "❌ Категорію не знайдено. Відкрив актуальне меню.",
+    try:
+        CATALOG = catalog
+        CURRENCY = CATALOG.get("currency", "EUR")
+
+        ITEM_INDEX = build_item_index()
+        ITEMS_BY_ID = build_id_index(ITEM_INDEX)
+        STATIC_MENUS = build_static_menus()
+        STOCK_MENUS = build_stock_menus()
+        refresh_stock_markups()
+
+        check_callback_data(
+            [menu[2] for menu in STATIC_MENUS.values()] + list(MARKUP_CACHE.values())
         )
-        return
+        PHOTO_BYTES = load_local_photos()
+    except Exception:
+        (
+            CATALOG,
+            CURRENCY,
+            ITEM_INDEX,
+            ITEMS_BY_ID,
+            STATIC_MENUS,
+            STOCK_MENUS,
+            markups,
+            PHOTO_BYTES,
+        ) = previous
+        MARKUP_CACHE.clear()
+        MARKUP_CACHE.update(markups)
+        raise
+
+    CATALOG_MTIME_NS = mtime
+
+    # Buttons already sent with an id that is gone now get the outdated-menu
+    # answer from add/reserve instead of resolving to another item.
+    retired = previous[3].keys() - ITEMS_BY_ID.keys()
+
+    logger.info(
+        "Catalog reloaded: %s items, %s old item buttons retired",
+        len(ITEM_INDEX),
+        len(retired),
+    )
+    return True
 
-    brands = cat.get("brands", {})
-    if not isinstance(brands, dict):
-        await show_text(update, "❌ У категорії немає брендів", kb_main(), context=context)
-        return
 
-    keyboard = []
+def reload_stock() -> bool:
+    """Re-read stock.json if it changed on disk and rebuild stock keyboards."""
+    global STOCK, STOCK_MTIME_NS
 
-    for brand_key, brand in brands.items():
-        keyboard.append([
-            InlineKeyboardButton(
-                brand["title"],
-                callback_data=f"brand:{cat_key}:{brand_key}",
-            )
-        ])
+    mtime = file_mtime_ns(STOCK_PATH)
+    if mtime is None or mtime == STOCK_MTIME_NS:
+        return False
 
-    keyboard.append([
-        InlineKeyboardButton("⬅ Назад", callback_data="catalog")
-    ])
+    stock = read_json(STOCK_PATH, None)
+    if not isinstance(stock, dict):
+        raise ValueError("stock.json is unreadable")
 
-    await show_photo(
+    STOCK = stock
+    STOCK_MTIME_NS = mtime
+    refresh_stock_markups()
+
+    logger.info("Stock reloaded: %s entries", len(STOCK))
+    return True
+
+# =========================================================
+# START
+# =========================================================
+
+
+# user_data keys reset by /start. active_menu_message_id is kept so the
+# previous menu message can still be cleaned up.
+SESSION_KEYS = (
+    "city_key",
+    "custom_city",
+    "awaiting_city",
+    "reserve_id",
+    "cart",
+    "cart_total",
+)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    for key in SESSION_KEYS:
+        context.user_data.pop(key, None)
+
+    await show_text(
         update,
-        context,
-        cat.get("photo", ""),
-        f"{cat['title']}\n\nОберіть бренд:",
-        InlineKeyboardMarkup(keyboard),
+        "👋 Вітаємо у ELF FOX\n\n📍 Оберіть ваше місто:",
+        KB_CITY,
+        context=context,
     )
 
 
-async def brand_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
 
     q = update.callback_query
@@ -882,146 +1310,124 @@ async def brand_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await show_stale_callback(update, context)
         return
 
-    parts = q.data.split(":")
-    if len(parts) != 3:
+    city_key = q.data.partition(":")[2]
+    if city_key not in CITY_CONFIG:
         await show_stale_callback(update, context)
         return
 
-    _, cat_key, brand_key = parts
-    brand = brand_get(cat_key, brand_key)
+    context.user_data["city_key"] = city_key
 
-    if not brand:
-        await show_stale_callback(
-            update,
-            context,
-            "❌ Бренд не знайдено. Відкрив актуальне меню.",
-        )
+    if city_key == "Other":
+        context.user_data["awaiting_city"] = True
+        await show_text(update, "✍️ Напишіть назву вашого міста:", context=context)
         return
 
-    keyboard = []
-    items = items_get(brand)
-
-    for idx, item in enumerate(items):
-        if isinstance(item, dict) and "nicotine" in item:
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{item['nicotine']} — {fmt_price(item['price'])}",
-                    callback_data=f"nic:{cat_key}:{brand_key}:{idx}",
-                )
-            ])
-        elif isinstance(item, dict) and isinstance(item.get("items"), list):
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{item['name']} — {fmt_price(item['price'])}",
-                    callback_data=f"flavors:{cat_key}:{brand_key}:{idx}",
-                )
-            ])
-        elif isinstance(item, dict):
-            key = item_key("brand", cat_key, brand_key, idx)
-            st = stock_get(key)
-
-            if st.get("in_stock", True):
-                label = f"{item['name']} — {fmt_price(item['price'])} ✅"
-                callback = f"add:{key}"
-            else:
-                eta = st.get("eta")
-                label = f"{item['name']} ❌"
-                if eta:
-                    label += f" ({eta})"
-                callback = f"reserve:{key}"
-
-            keyboard.append([
-                InlineKeyboardButton(label, callback_data=callback)
-            ])
+    await show_main(update, context)
 
-    keyboard.append([
-        InlineKeyboardButton("🛒 Кошик", callback_data="cart")
-    ])
-    keyboard.append([
-        InlineKeyboardButton("⬅ Назад", callback_data=f"cat:{cat_key}")
-    ])
 
-    text = f"{brand['title']}"
-    if brand.get("price_range"):
-        text += f"\n💶 {brand['price_range']}"
-    text += "\n\nОберіть товар:"
+async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    city = get_city_title(context)
 
-    await show_photo(
+    await show_text(
         update,
-        context,
-        brand.get("photo", ""),
-        text,
-        InlineKeyboardMarkup(keyboard),
+        f"🦊 ELF FOX\n\n📍 Ваше місто: {city}\n\nОберіть дію:",
+        KB_MAIN,
+        context=context,
     )
 
 
-async def nicotine_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def main_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
+    await show_main(update, context)
 
-    q = update.callback_query
-    if not q or not q.data:
-        await show_stale_callback(update, context)
-        return
+# =========================================================
+# TEXT ROUTER
+# =========================================================
 
-    parts = q.data.split(":")
-    if len(parts) != 4:
-        await show_stale_callback(update, context)
-        return
 
-    _, cat_key, brand_key, block_idx = parts
+async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text = (update.message.text or "").strip()
 
-    brand = brand_get(cat_key, brand_key)
-    block_index = parse_idx(block_idx)
+    if context.user_data.get("awaiting_city"):
+        context.user_data["custom_city"] = text
+        context.user_data["awaiting_city"] = False
 
-    if not brand or block_index is None:
-        await show_stale_callback(update, context)
+        await show_main(update, context)
+        await delete_message_safe(
+            context,
+            update.effective_chat.id,
+            update.message.message_id,
+        )
         return
 
-    brand_items = items_get(brand)
-    if block_index < 0 or block_index >= len(brand_items):
-        await show_stale_callback(update, context)
-        return
+    if context.user_data.get("reserve_id"):
+        # Stored as the item id, so a catalog reload between the tap and
+        # this message cannot turn it into a different product.
+        item = resolve_callback_item(context.user_data["reserve_id"])
 
-    block = brand_items[block_index]
-    if not isinstance(block, dict):
-        await show_stale_callback(update, context)
-        return
+        if not item:
+            context.user_data.pop("reserve_id", None)
+            await show_stale_callback(update, context)
+            return
 
-    keyboard = []
+        st = stock_get(item.key)
 
-    for idx, flavor in enumerate(items_get(block)):
-        flavor_name = extract_flavor_name(flavor)
-        key = item_key("nic", cat_key, brand_key, block_idx, idx)
-        st = stock_get(key)
+        reservation_text = (
+            "📌 НОВЕ БРОНЮВАННЯ\n\n"
+            f"👤 {get_username(update.effective_user)}\n"
+            f"📍 Місто: {get_city_title(context)}\n\n"
+            f"🧾 {item.name}\n"
+            f"💶 {fmt_price(item.price)}\n"
+            f"🗓 Очікується: {st.get('eta') or 'не вказано'}\n\n"
+            f"💬 Контакт:\n{text}"
+        )
 
-        if st.get("in_stock", True):
-            label = f"{flavor_name} ✅"
-            callback = f"add:{key}"
-        else:
-            eta = st.get("eta")
-            label = f"{flavor_name} ❌"
-            if eta:
-                label += f" ({eta})"
-            callback = f"reserve:{key}"
+        delivered, _ = await notify_targets(context, ADMIN_IDS, reservation_text)
 
-        keyboard.append([
-            InlineKeyboardButton(label, callback_data=callback)
-        ])
+        if not delivered:
+            await show_text(
+                update,
+                "❌ Не вдалося передати бронювання. Спробуйте ще раз трохи пізніше.",
+                KB_MAIN,
+                context=context,
+                cleanup_user=True,
+            )
+            return
 
-    keyboard.append([
-        InlineKeyboardButton("⬅ Назад", callback_data=f"brand:{cat_key}:{brand_key}")
-    ])
+        context.user_data.pop("reserve_id", None)
 
-    await show_photo(
+        await show_text(
+            update,
+            "✅ Бронювання передано адміну",
+            KB_MAIN,
+            context=context,
+            cleanup_user=True,
+        )
+        return
+
+    if not has_city(context):
+        await start(update, context)
+        await delete_message_safe(
+            context,
+            update.effective_chat.id,
+            update.message.message_id,
+        )
+        return
+
+    await show_text(
         update,
-        context,
-        block.get("photo") or brand.get("photo", ""),
-        f"{brand['title']} {block['nicotine']}\n\nОберіть смак:",
-        InlineKeyboardMarkup(keyboard),
+        "Я не очікував текст у цей момент. Скористайся кнопками нижче.",
+        KB_MAIN,
+        context=context,
+        cleanup_user=True,
     )
 
+# =========================================================
+# CATALOG
+# =========================================================
+
 
-async def flavors_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
 
     q = update.callback_query
@@ -1029,62 +1435,54 @@ async def flavors_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_stale_callback(update, context)
         return
 
-    parts = q.data.split(":")
-    if len(parts) != 4:
-        await show_stale_callback(update, context)
-        return
-
-    _, cat_key, brand_key, parent_idx = parts
+    menu = STATIC_MENUS.get(q.data)
 
-    brand = brand_get(cat_key, brand_key)
-    parent_index = parse_idx(parent_idx)
+    if not menu:
+        if q.data == "catalog":
+            await show_text(update, "❌ Каталог тимчасово недоступний", KB_MAIN, context=context)
+            return
 
-    if not brand or parent_index is None:
-        await show_stale_callback(update, context)
+        await show_stale_callback(
+            update,
+            context,
+            "❌ Категорію не знайдено. Відкрив актуальне меню.",
+        )
         return
 
-    brand_items = items_get(brand)
-    if parent_index < 0 or parent_index >= len(brand_items):
-        await show_stale_callback(update, context)
-        return
+    photo, text, reply_markup = menu
 
-    parent = brand_items[parent_index]
-    if not isinstance(parent, dict):
-        await show_stale_callback(update, context)
+    if photo:
+        await show_photo(update, context, photo, text, reply_markup)
         return
 
-    keyboard = []
+    await show_text(update, text, reply_markup, context=context)
 
-    for idx, flavor in enumerate(items_get(parent)):
-        flavor_name = extract_flavor_name(flavor)
-        key = item_key("flv", cat_key, brand_key, parent_idx, idx)
-        st = stock_get(key)
 
-        if st.get("in_stock", True):
-            label = f"{flavor_name} ✅"
-            callback = f"add:{key}"
-        else:
-            eta = st.get("eta")
-            label = f"{flavor_name} ❌"
-            if eta:
-                label += f" ({eta})"
-            callback = f"reserve:{key}"
+async def stock_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await answer_callback(update)
 
-        keyboard.append([
-            InlineKeyboardButton(label, callback_data=callback)
-        ])
+    q = update.callback_query
+    if not q or not q.data:
+        await show_stale_callback(update, context)
+        return
 
-    keyboard.append([
-        InlineKeyboardButton("⬅ Назад", callback_data=f"brand:{cat_key}:{brand_key}")
-    ])
+    menu = STOCK_MENUS.get(q.data)
+    reply_markup = MARKUP_CACHE.get(q.data)
 
-    await show_photo(
-        update,
-        context,
-        parent.get("photo") or brand.get("photo", ""),
-        f"{parent['name']}\n\nОберіть смак:",
-        InlineKeyboardMarkup(keyboard),
-    )
+    if not menu or not reply_markup:
+        if q.data.startswith("brand:"):
+            await show_stale_callback(
+                update,
+                context,
+                "❌ Бренд не знайдено. Відкрив актуальне меню.",
+            )
+            return
+
+        await show_stale_callback(update, context)
+        return
+
+    photo, text, _ = menu
+    await show_photo(update, context, photo, text, reply_markup)
 
 # =========================================================
 # ADD / RESERVE
@@ -1099,38 +1497,41 @@ async def add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await show_stale_callback(update, context)
         return
 
-    key = q.data.split(":", 1)[1]
-    item = resolve_item(key)
+    item = resolve_callback_item(q.data.partition(":")[2])
 
     if not item:
-        await show_text(update, "❌ Товар не знайдено", context=context)
+        await show_stale_callback(update, context)
         return
 
+    key = item.key
+
     st = stock_get(key)
     if not st.get("in_stock", True):
         await show_text(
             update,
             "❌ Цього товару вже немає в наявності",
-            kb_main(),
+            KB_MAIN,
             context=context,
         )
         return
 
-    cart = cart_get(context)
-    cart.append({
-        "key": item["key"],
-        "name": item["name"],
-        "price": item["price"],
-    })
+    if len(cart_get(context)) >= MAX_CART_ITEMS:
+        await show_text(
+            update,
+            f"❌ Кошик заповнений (максимум {MAX_CART_ITEMS}). Оформи замовлення або видали зайве.",
+            KB_CART_HOME,
+            context=context,
+        )
+        return
+
+    cart_add(context, item.cart_item)
 
     await show_photo(
         update,
         context,
-        item.get("photo", ""),
-        "✅ Додано в кошик\n\n"
-        f"🧾 {item['name']}\n"
-        f"💶 {fmt_price(item['price'])}",
-        kb_after_add(),
+        item.photo,
+        item.added_text,
+        KB_AFTER_ADD,
     )
 
 
@@ -1142,21 +1543,22 @@ async def reserve_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_stale_callback(update, context)
         return
 
-    key = q.data.split(":", 1)[1]
-    item = resolve_item(key)
+    item = resolve_callback_item(q.data.partition(":")[2])
 
     if not item:
-        await show_text(update, "❌ Товар не знайдено", context=context)
+        await show_stale_callback(update, context)
         return
 
+    key = item.key
+
     st = stock_get(key)
-    context.user_data["reserve_key"] = key
+    context.user_data["reserve_id"] = item.id
 
     await show_text(
         update,
         "📌 Бронювання\n\n"
-        f"🧾 {item['name']}\n"
-        f"💶 {fmt_price(item['price'])}\n"
+        f"🧾 {item.name}\n"
+        f"💶 {fmt_price(item.price)}\n"
         f"🗓 Очікується: {st.get('eta') or 'дату уточнюйте'}\n\n"
         "✍️ Напишіть контакт або коментар:",
         context=context,
@@ -1166,6 +1568,9 @@ async def reserve_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # CART
 # =========================================================
 
+EMPTY_CART_TEXT = "🛒 Кошик порожній"
+CLEARED_CART_TEXT = "🗑 Кошик очищено"
+
 
 async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
@@ -1175,43 +1580,30 @@ async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not cart:
         await show_text(
             update,
-            "🛒 Кошик порожній",
-            InlineKeyboardMarkup([
-                [InlineKeyboardButton("🛍 Каталог", callback_data="catalog")],
-                [InlineKeyboardButton("⬅ На головну", callback_data="main")],
-            ]),
+            EMPTY_CART_TEXT,
+            KB_CATALOG_HOME,
             context=context,
         )
         return
 
     lines = [
-        f"{idx + 1}. {item['name']} — {fmt_price(item['price'])}"
-        for idx, item in enumerate(cart)
+        f"{idx}. {item.name} — {fmt_price(item.price)}"
+        for idx, item in enumerate(cart, 1)
     ]
 
     text = (
         "🛒 Ваше замовлення:\n\n"
         + "\n".join(lines)
-        + f"\n\n💰 Разом: {fmt_price(cart_total(cart))}"
+        + f"\n\n💰 Разом: {fmt_price(cart_total(context))}"
     )
 
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Додати ще", callback_data="catalog")],
-        [InlineKeyboardButton("➖ Прибрати останній", callback_data="remove_last")],
-        [InlineKeyboardButton("🗑 Очистити кошик", callback_data="clear_cart")],
-        [InlineKeyboardButton("✅ Оформити", callback_data="checkout")],
-        [InlineKeyboardButton("⬅ На головну", callback_data="main")],
-    ])
-
-    await show_text(update, text, keyboard, context=context)
+    await show_text(update, text, KB_CART, context=context)
 
 
 async def remove_last_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
 
-    cart = cart_get(context)
-    if cart:
-        cart.pop()
+    cart_remove_last(context)
 
     await cart_handler(update, context)
 
@@ -1219,12 +1611,12 @@ async def remove_last_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def clear_cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
 
-    context.user_data["cart"] = []
+    cart_clear(context)
 
     await show_text(
         update,
-        "🗑 Кошик очищено",
-        kb_main(),
+        CLEARED_CART_TEXT,
+        KB_MAIN,
         context=context,
     )
 
@@ -1236,123 +1628,137 @@ async def clear_cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await answer_callback(update)
 
-    if context.user_data.get("checkout_in_progress"):
+    user = update.effective_user
+    cart = cart_get(context)
+
+    if not cart:
+        await show_text(update, EMPTY_CART_TEXT, context=context)
+        return
+
+    unavailable = [
+        item.name
+        for item in cart
+        if not stock_get(item.key).get("in_stock", True)
+    ]
+
+    if unavailable:
         await show_text(
             update,
-            "⏳ Замовлення вже обробляється. Зачекай кілька секунд.",
+            "❌ Деякі товари вже не в наявності:\n\n"
+            + "\n".join([f"• {x}" for x in unavailable]),
+            KB_MAIN,
             context=context,
         )
         return
 
-    context.user_data["checkout_in_progress"] = True
+    city = get_city_title(context)
+    city_cfg = get_city_config(context)
+    total = cart_total(context)
 
-    try:
-        user = update.effective_user
-        cart = cart_get(context)
+    now = time.time()
+    order_id = f"{user.id}-{int(now)}"
+    timestamp = fmt_timestamp(now)
 
-        if not cart:
-            await show_text(update, "🛒 Кошик порожній", context=context)
-            return
+    items_text = "\n".join([
+        f"• {item.name} — {fmt_price(item.price)}"
+        for item in cart
+    ])
 
-        unavailable = []
+    order_text = (
+        "📦 НОВЕ ЗАМОВЛЕННЯ\n\n"
+        f"🆔 ID: {order_id}\n"
+        f"👤 {get_username(user)}\n"
+        f"📍 Місто: {city}\n\n"
+        f"🛒 Товари:\n{items_text}\n\n"
+        f"💰 Разом: {fmt_price(total)}\n"
+        f"🕒 {timestamp}"
+    )
 
-        for item in cart:
-            st = stock_get(item["key"])
-            if not st.get("in_stock", True):
-                unavailable.append(item["name"])
+    (delivered_admins, failed_admins), courier_sent = await asyncio.gather(
+        notify_targets(context, ADMIN_IDS, order_text),
+        send_message_safe(context, city_cfg["courier_chat_id"], order_text),
+    )
 
-        if unavailable:
-            await show_text(
-                update,
-                "❌ Деякі товари вже не в наявності:\n\n"
-                + "\n".join(f"• {x}" for x in unavailable),
-                kb_main(),
-                context=context,
-            )
-            return
+    if not delivered_admins and not courier_sent:
+        await show_text(
+            update,
+            "❌ Не вдалося передати замовлення. Кошик збережено, спробуй ще раз трохи пізніше.",
+            KB_CART_HOME,
+            context=context,
+        )
+        return
 
-        city = get_city_title(context)
-        city_cfg = get_city_config(context)
+    save_order({
+        "order_id": order_id,
+        "city": city,
+        "user_id": user.id,
+        "items": [item._asdict() for item in cart],
+        "total": total,
+        "created_at": timestamp,
+        "courier_sent": courier_sent,
+        "admin_delivered": delivered_admins,
+        "admin_failed": failed_admins,
+    })
 
-        order_id = f"{user.id}-{int(datetime.now().timestamp())}"
-        timestamp = datetime.now().strftime("%d.%m.%Y %H:%M")
+    cart_clear(context)
 
-        items_text = "\n".join(
-            f"• {item['name']} — {fmt_price(item['price'])}"
-            for item in cart
+    if courier_sent:
+        success_text = (
+            "✅ Дякуємо за замовлення\n\n"
+            f"Курʼєр звʼяжеться з вами:\n{city_cfg['courier_username']}"
         )
-
-        order_text = (
-            "📦 НОВЕ ЗАМОВЛЕННЯ\n\n"
-            f"🆔 ID: {order_id}\n"
-            f"👤 {get_username(user)}\n"
-            f"📍 Місто: {city}\n\n"
-            f"🛒 Товари:\n{items_text}\n\n"
-            f"💰 Разом: {fmt_price(cart_total(cart))}\n"
-            f"🕒 {timestamp}"
+    else:
+        success_text = (
+            "✅ Замовлення прийнято\n\n"
+            "Курʼєру не вдалося відправити повідомлення автоматично, "
+            "але адміністратор уже отримав замовлення і звʼяжеться з вами."
         )
 
-        delivered_admins, failed_admins = await notify_targets(
-            context,
-            ADMIN_IDS,
-            order_text,
-        )
+    await show_text(
+        update,
+        success_text,
+        KB_CATALOG_HOME,
+        context=context,
+    )
 
-        courier_sent = await send_message_safe(
-            context,
-            city_cfg["courier_chat_id"],
-            order_text,
-        )
+# =========================================================
+# ADMIN
+# =========================================================
 
-        if not delivered_admins and not courier_sent:
-            await show_text(
-                update,
-                "❌ Не вдалося передати замовлення. Кошик збережено, спробуй ще раз трохи пізніше.",
-                InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛒 Кошик", callback_data="cart")],
-                    [InlineKeyboardButton("⬅ На головну", callback_data="main")],
-                ]),
-                context=context,
-            )
-            return
 
-        save_order({
-            "order_id": order_id,
-            "city": city,
-            "user_id": user.id,
-            "items": cart,
-            "total": cart_total(cart),
-            "created_at": timestamp,
-            "courier_sent": courier_sent,
-            "admin_delivered": delivered_admins,
-            "admin_failed": failed_admins,
-        })
-
-        context.user_data["cart"] = []
-
-        if courier_sent:
-            success_text = (
-                "✅ Дякуємо за замовлення\n\n"
-                f"Курʼєр звʼяжеться з вами:\n{city_cfg['courier_username']}"
-            )
-        else:
-            success_text = (
-                "✅ Замовлення прийнято\n\n"
-                "Курʼєру не вдалося відправити повідомлення автоматично, "
-                "але адміністратор уже отримав замовлення і звʼяжеться з вами."
-            )
+async def reload_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
 
-        await show_text(
-            update,
-            success_text,
-            InlineKeyboardMarkup([
-                [InlineKeyboardButton("🛍 Каталог", callback_data="catalog")],
-                [InlineKeyboardButton("⬅ На головну", callback_data="main")],
-            ]),
-            context=context,
-        )
-    finally:
-        context.user_data.pop("checkout_in_progress", None)
+    # Let queued stock writes land first, so reload_stock never reads a file
+    # older than the in-memory STOCK.
+    await wait_for_pending_writes()
+
+    lines = []
+
+    try:
+        if reload_catalog():
+            lines.append(f"🔄 Каталог оновлено: {len(ITEM_INDEX)} товарів")
+    except Exception as e:
+        logger.exception("Catalog reload failed: %s", e)
+        lines.append(f"❌ catalog.json не застосовано, працює попередній: {e!r}")
+
+    changed_photos = reload_photos()
+    if changed_photos:
+        lines.append(f"🔄 Фото оновлено: {changed_photos}")
+
+    try:
+        if reload_stock():
+            lines.append(f"🔄 Наявність оновлено: {len(STOCK)} позицій")
+    except Exception as e:
+        logger.exception("Stock reload failed: %s", e)
+        lines.append(f"❌ stock.json не застосовано, працює попередній: {e!r}")
+
+    if not lines:
+        await update.message.reply_text("ℹ️ catalog.json і stock.json не змінились")
+        return
+
+    await update.message.reply_text("\n".join(lines))
 
 # =========================================================
 # FALLBACKS / ERRORS
@@ -1364,6 +1770,32 @@ async def unknown_callback_handler(update: Update, context: ContextTypes.DEFAULT
     await show_stale_callback(update, context)
 
 
+# callback_data prefix (text before the first ":") -> handler.
+CALLBACK_ROUTES: Dict[str, Callable[..., Awaitable[None]]] = {
+    "city": city_handler,
+    "main": main_handler,
+    "catalog": menu_handler,
+    "cat": menu_handler,
+    "brand": stock_menu_handler,
+    "nic": stock_menu_handler,
+    "flavors": stock_menu_handler,
+    "add": add_handler,
+    "reserve": reserve_handler,
+    "cart": cart_handler,
+    "remove_last": remove_last_handler,
+    "clear_cart": clear_cart_handler,
+    "checkout": checkout_handler,
+}
+
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    prefix = q.data.partition(":")[0] if q and q.data else ""
+
+    handler = CALLBACK_ROUTES.get(prefix, unknown_callback_handler)
+    await handler(update, context)
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.exception("Unhandled exception: %s", context.error)
 
@@ -1372,51 +1804,203 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 # =========================================================
 
 
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, but one at a time for any single user.
+
+    Handlers read and write the user's cart in several steps, so two taps
+    from the same user must not interleave.
+    """
+
+    __slots__ = ("_user_locks",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # user id -> [lock, number of updates holding or waiting for it]
+        self._user_locks: Dict[int, List[Any]] = {}
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Wait for the user's lock before taking a concurrency slot, so one
+        # user's backlog (or a handler stuck retrying a 429) cannot occupy
+        # slots that other users' updates need.
+        user = update.effective_user if isinstance(update, Update) else None
+
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class BatchedPicklePersistence(PicklePersistence):
+    """Writes the pickle file once per persistence run, off the event loop.
+
+    Stock PicklePersistence re-pickles the whole file for every changed user,
+    synchronously and in place. Here updates only touch the in-memory copy
+    and mark it dirty; one background task dumps it to a temp file in a
+    worker thread and swaps it in.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, on_flush=True, **kwargs)
+        self._dirty = False
+        self._dump_task: Optional[asyncio.Task] = None
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if self.user_data is not None and self.user_data.get(user_id) == data:
+            return
+        await super().update_user_data(user_id, data)
+        self._mark_dirty()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await super().drop_user_data(user_id)
+        self._mark_dirty()
+
+    async def flush(self) -> None:
+        if self._dump_task is not None:
+            await self._dump_task
+        await super().flush()
+
+    def _mark_dirty(self) -> None:
+        self._dirty = True
+        # The application gathers one update per changed user; they all run
+        # before this task starts, so a whole run shares a single dump.
+        if self._dump_task is None or self._dump_task.done():
+            self._dump_task = asyncio.create_task(self._dump_in_background())
+
+    async def _dump_in_background(self) -> None:
+        while self._dirty:
+            self._dirty = False
+            # Copy the outer dict here: the thread must not see it change.
+            # The per-user dicts are deep copies the application hands over.
+            data = self._state()
+            data["user_data"] = dict(self.user_data or {})
+            try:
+                await asyncio.to_thread(self._write_state, data)
+            except Exception:
+                logger.exception("Failed to save %s", self.filepath)
+
+    def _dump_singlefile(self) -> None:
+        self._write_state(self._state())
+
+    def _state(self) -> Dict[str, Any]:
+        return {
+            "conversations": self.conversations,
+            "user_data": self.user_data,
+            "chat_data": self.chat_data,
+            "bot_data": self.bot_data,
+            "callback_data": self.callback_data,
+        }
+
+    def _write_state(self, data: Dict[str, Any]) -> None:
+        tmp = self.filepath.with_name(self.filepath.name + ".tmp")
+        with tmp.open("wb") as file:
+            _BotPickler(self.bot, file, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+        tmp.replace(self.filepath)
+
+
 def build_application() -> Application:
+    # Only user_data (city, cart) needs to survive restarts. Changed carts are
+    # saved every 5s in one background dump, so a crash loses seconds of
+    # cart edits without blocking the loop on pickling.
+    persistence = BatchedPicklePersistence(
+        filepath=STATE_PATH,
+        store_data=PersistenceInput(
+            bot_data=False,
+            chat_data=False,
+            user_data=True,
+            callback_data=False,
+        ),
+        update_interval=5,
+    )
+
     app = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
-        .concurrent_updates(False)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .pool_timeout(30)
+        # Stays under Telegram's flood limits and retries after a 429.
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_shutdown(save_state_on_shutdown)
         .build()
     )
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reload", reload_handler))
 
     app.add_handler(
         MessageHandler(
-            filters.TEXT & ~filters.COMMAND,
+            filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND,
             text_router,
         )
     )
 
-    app.add_handler(CallbackQueryHandler(city_handler, pattern=r"^city:"))
-    app.add_handler(CallbackQueryHandler(main_handler, pattern=r"^main$"))
+    app.add_handler(CallbackQueryHandler(callback_router))
+    app.add_error_handler(error_handler)
+
+    return app
 
-    app.add_handler(CallbackQueryHandler(catalog_handler, pattern=r"^catalog$"))
-    app.add_handler(CallbackQueryHandler(category_handler, pattern=r"^cat:"))
-    app.add_handler(CallbackQueryHandler(brand_handler, pattern=r"^brand:"))
-    app.add_handler(CallbackQueryHandler(nicotine_handler, pattern=r"^nic:"))
-    app.add_handler(CallbackQueryHandler(flavors_handler, pattern=r"^flavors:"))
 
-    app.add_handler(CallbackQueryHandler(add_handler, pattern=r"^add:"))
-    app.add_handler(CallbackQueryHandler(reserve_handler, pattern=r"^reserve:"))
+def install_event_loop() -> None:
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio loop")
+        return
 
-    app.add_handler(CallbackQueryHandler(cart_handler, pattern=r"^cart$"))
-    app.add_handler(CallbackQueryHandler(remove_last_handler, pattern=r"^remove_last$"))
-    app.add_handler(CallbackQueryHandler(clear_cart_handler, pattern=r"^clear_cart$"))
-    app.add_handler(CallbackQueryHandler(checkout_handler, pattern=r"^checkout$"))
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    app.add_handler(CallbackQueryHandler(unknown_callback_handler))
-    app.add_error_handler(error_handler)
 
-    return app
+# Only these update types have handlers; Telegram does not need to send others.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 
 def main() -> None:
+    install_event_loop()
     app = build_application()
 
-    logger.info("Bot started")
+    if WEBHOOK_URL:
+        # The URL path usually carries a secret, so only log where it points.
+        webhook = urlparse(WEBHOOK_URL)
+        logger.info("Bot started (webhook: %s://%s)", webhook.scheme, webhook.netloc)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=webhook.path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            close_loop=False,
+            drop_pending_updates=True,
+        )
+        return
+
+    logger.info("Bot started (polling)")
     app.run_polling(
+        # Long-poll for 30s so an idle bot makes ~2 getUpdates calls a minute.
+        timeout=30,
+        allowed_updates=ALLOWED_UPDATES,
         close_loop=False,
         drop_pending_updates=True,
     )